@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# kuaiquctl - control library and CLI for KUAIQU DC power supplies
+# Copyright (C) 2025 Woazboat
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# asyncio interface, requires the optional pyserial-asyncio dependency (kuaiqu-psu[asyncio])
+# Commands to different power supplies can be in flight concurrently, e.g.
+#   await asyncio.gather(psu1.set_voltage(5), psu2.set_voltage(3.3))
+
+import asyncio
+from contextlib import AbstractAsyncContextManager
+from typing import Any
+import logging
+
+import serial_asyncio # type: ignore
+
+from .kuaiqu_psu import PowerSupply, _encode_setpoint, _limit_setpoint, _cached_setpoint_rsp, _setpoint_cache_entry, \
+    _setpoints_ok, _parse_measurement, _LT, _FRAME_LEN, _TIMEOUT, _FUNC_SET_VOLTAGE, _FUNC_SET_CURRENT, \
+    _CMD_ENABLE_OUTPUT, _CMD_DISABLE_OUTPUT, _CMD_READ_VOLTAGE, _CMD_READ_CURRENT, _CMD_LOCK, _CMD_UNLOCK
+
+_log = logging.getLogger(__name__)
+
+
+class AsyncPowerSupply(AbstractAsyncContextManager[Any]):
+
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    max_voltage: float | None
+    max_current: float | None
+    timeout: float | None
+
+    _lock: asyncio.Lock
+    _last_voltage: tuple[int, PowerSupply.Command] | None
+    _last_current: tuple[int, PowerSupply.Command] | None
+
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 max_voltage: int|None = 60, max_current: int|None = 5, timeout: float|None = _TIMEOUT):
+        self.reader = reader
+        self.writer = writer
+        self.max_voltage = max_voltage
+        self.max_current = max_current
+        self.timeout = timeout
+        self._lock = asyncio.Lock()
+        self._last_voltage = None
+        self._last_current = None
+
+
+    @classmethod
+    async def open(cls, port: str, **kwargs: Any):
+        reader, writer = await serial_asyncio.open_serial_connection(url=port, baudrate=9600)
+        return cls(reader, writer, **kwargs)
+
+
+    async def __aexit__(self, *args, **kwargs) -> bool | None: # type: ignore
+        await self.close()
+        return await super().__aexit__(*args, **kwargs) # type: ignore
+
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+    async def send_cmd(self, cmd: PowerSupply.Command, read_response: bool = True):
+        rsp_data = await self._send_raw(cmd.encode(), read_response)
+        return PowerSupply.Command.from_bytes(rsp_data) if rsp_data else None
+
+
+    async def _send_raw(self, cmd_data: bytes, read_response: bool = True):
+        _log.debug("CMD -> %s", cmd_data)
+        async with self._lock:
+            if read_response:
+                await self._discard_stale_input()
+            self.writer.write(cmd_data)
+            await self.writer.drain()
+            if not read_response:
+                return None
+            try:
+                rsp_data = await asyncio.wait_for(self._read_frame(), self.timeout)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return None
+        _log.debug("RSP <- %s", rsp_data)
+        return rsp_data
+
+
+    # Drop late responses to earlier commands that timed out, so they are not mistaken for the next response
+    async def _discard_stale_input(self):
+        while True:
+            # read() returns buffered data without suspending, so the read is done after a single loop iteration
+            # if anything was buffered. Otherwise it is waiting for new data and is cancelled.
+            read = asyncio.ensure_future(self.reader.read(1024))
+            await asyncio.sleep(0)
+            if not read.done():
+                read.cancel()
+                await asyncio.wait((read,))
+                return
+            stale = read.result()
+            if not stale:
+                return
+            _log.warning('WARNING: Discarding stale input: %s', stale)
+
+
+    # Same framing and resynchronization as PowerSupply._read_frame()
+    async def _read_frame(self):
+        rsp_data = await self.reader.readexactly(_FRAME_LEN)
+        if rsp_data[0:1] != _LT:
+            _log.warning('WARNING: Discarding stray bytes in front of response: %s', rsp_data)
+            start = rsp_data.find(_LT)
+            if start < 0:
+                await self.reader.readuntil(_LT)
+                rsp_data = _LT
+            else:
+                rsp_data = rsp_data[start:]
+            rsp_data += await self.reader.readexactly(_FRAME_LEN - len(rsp_data))
+        return rsp_data
+
+
+    async def output(self, enable: bool):
+        _log.info('Set output: %s', enable)
+        # No response for output enable/disable command
+        await self._send_raw(_CMD_ENABLE_OUTPUT if enable else _CMD_DISABLE_OUTPUT, read_response=False)
+
+
+    # Same semantics as PowerSupply.set_voltage()
+    async def set_voltage(self, voltage: float, force: bool = False):
+        voltage = _limit_setpoint(voltage, self.max_voltage, 'voltage')
+
+        millis = round(voltage * 1000)
+        cached_rsp = _cached_setpoint_rsp(self._last_voltage, millis, force)
+        if cached_rsp is not None:
+            _log.info('Voltage already set: %sV', voltage)
+            return cached_rsp
+
+        _log.info('Set voltage: %sV', voltage)
+
+        rsp_data = await self._send_raw(_encode_setpoint(_FUNC_SET_VOLTAGE, millis))
+        rsp = PowerSupply.Command.from_bytes(rsp_data) if rsp_data else None
+        self._last_voltage = _setpoint_cache_entry(millis, rsp)
+        return rsp
+
+
+    # Same semantics as PowerSupply.set_current()
+    async def set_current(self, current: float, force: bool = False):
+        current = _limit_setpoint(current, self.max_current, 'current')
+
+        millis = round(current * 1000)
+        cached_rsp = _cached_setpoint_rsp(self._last_current, millis, force)
+        if cached_rsp is not None:
+            _log.info('Current already set: %sA', current)
+            return cached_rsp
+
+        _log.info('Set current: %sA', current)
+
+        rsp_data = await self._send_raw(_encode_setpoint(_FUNC_SET_CURRENT, millis))
+        rsp = PowerSupply.Command.from_bytes(rsp_data) if rsp_data else None
+        self._last_current = _setpoint_cache_entry(millis, rsp)
+        return rsp
+
+
+    async def read_voltage(self):
+        _log.info('Read voltage')
+        rsp = await self._send_raw(_CMD_READ_VOLTAGE)
+        if rsp:
+            voltage, mode = _parse_measurement(rsp)
+            _log.info('Voltage: %s', voltage)
+            return voltage, mode
+        return None
+
+
+    async def read_current(self):
+        _log.info('Read current')
+        rsp = await self._send_raw(_CMD_READ_CURRENT)
+        if rsp:
+            current, mode = _parse_measurement(rsp)
+            _log.info('Current: %s', current)
+            return current, mode
+        return None
+
+
+    async def lock_buttons(self, lock: bool):
+        _log.info('Set button lock: %s', lock)
+        rsp_data = await self._send_raw(_CMD_LOCK if lock else _CMD_UNLOCK)
+        return PowerSupply.Command.from_bytes(rsp_data) if rsp_data else None
+
+
+    # Same semantics as PowerSupply.apply(), but the commands are sent one after another
+    async def apply(self, voltage: float | None = None, current: float | None = None, enable: bool | None = None):
+        if enable is False:
+            await self.output(False)
+        voltage_rsp = await self.set_voltage(voltage) if voltage is not None else None
+        current_rsp = await self.set_current(current) if current is not None else None
+
+        if enable:
+            if _setpoints_ok((voltage, voltage_rsp), (current, current_rsp)):
+                await self.output(True)
+            else:
+                _log.warning('WARNING: Output not enabled, setpoints were not acknowledged')
+        return voltage_rsp, current_rsp
@@ -18,11 +18,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from contextlib import AbstractContextManager
-from dataclasses import dataclass
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass, field
 from enum import Enum, StrEnum
 import math
-from typing import Any
+import queue
+import threading
+from typing import Any, Callable, NamedTuple
 import serial
 import logging
 
@@ -31,8 +33,54 @@ _log = logging.getLogger(__name__)
 
 _TIMEOUT = 1
 
-def _split_int_fractional(f: float):
-    return int(f), f % 1
+_LT = b'<'
+_GT = b'>'
+_FRAME_LEN = 13
+
+# Zero-padded 3 digit ASCII encoding of 0-999 for the data fields of setpoint commands
+_D3 = tuple(f'{i:03}'.encode('ascii') for i in range(1000))
+
+# Setpoints are handled as integer milli-volts/amperes, float modulo would turn e.g. 3.3 into 3.299
+def _encode_setpoint(function: bytes, millis: int):
+    int_part, fractional_part = divmod(millis, 1000)
+    if not 0 <= int_part < len(_D3):
+        raise ValueError(f'Setpoint {millis / 1000} out of range, must be between 0 and 999.999')
+    return b''.join((_LT, b'0', function, _D3[int_part], _D3[fractional_part], b'000', _GT))
+
+
+# Helpers shared by PowerSupply and aio.AsyncPowerSupply
+
+def _limit_setpoint(value: float, maximum: float | None, name: str):
+    assert math.isfinite(value)
+    assert value >= 0
+
+    if maximum is not None and value > maximum:
+        _log.warning('WARNING: Requested %s %s > maximum %s %s', name, value, name, maximum)
+        value = min(value, maximum)
+    return value
+
+
+# Previous response if the setpoint was already acknowledged, None if it has to be sent
+def _cached_setpoint_rsp(last: 'tuple[int, PowerSupply.Command] | None', millis: int, force: bool):
+    if not force and last is not None and last[0] == millis:
+        return last[1]
+    return None
+
+
+def _setpoint_cache_entry(millis: int, rsp: 'PowerSupply.Command | PowerSupply.PendingResponse | None'):
+    return (millis, rsp) if isinstance(rsp, PowerSupply.Command) and rsp.is_ok_rsp() else None
+
+
+# True if all requested setpoints (value not None) were acknowledged with OK
+def _setpoints_ok(*requested: 'tuple[float | None, PowerSupply.Command | None]'):
+    return all(rsp is not None and rsp.is_ok_rsp() for value, rsp in requested if value is not None)
+
+
+# Value and mode from a read voltage/current response
+def _parse_measurement(rsp: bytes):
+    address, _, data1, data2, _ = PowerSupply.Command.parse_response_bytes(rsp)
+    value = (int(data1) * 1000 + int(data2)) / 1000
+    return value, PowerSupply.Mode.CONSTANT_VOLTAGE if address == b'1' else PowerSupply.Mode.CONSTANT_CURRENT
 
 
 class PowerSupply(AbstractContextManager[Any]):
@@ -42,10 +90,15 @@ class PowerSupply(AbstractContextManager[Any]):
     max_current: float | None
 
     _close_port: bool
+    _pipeline: 'PowerSupply._PipelineState'
+    _tx_lock: threading.Lock
+    _rx_q: queue.Queue[bytes]
+    _reader: threading.Thread | None
+    _last_voltage: tuple[int, 'PowerSupply.Command'] | None
+    _last_current: tuple[int, 'PowerSupply.Command'] | None
 
 
-    @dataclass
-    class Command:
+    class Command(NamedTuple):
         address: str = '0'
         function: str = '2'
         data1: str = '000'
@@ -65,24 +118,29 @@ class PowerSupply(AbstractContextManager[Any]):
             LOCK = '100'
             UNLOCK = '200'
         
+        # Setpoint and fixed commands are sent pre-encoded and do not go through encode()
         def encode(self):
             return f'<{self.address:1}{self.function:1}{self.data1:03}{self.data2:03}{self.device:03}>'.encode()
         
         @staticmethod
         def from_str(s: str):
-            assert s
-            assert len(s)== 13
-            assert s[0] == '<'
-            assert s[-1] == '>'
-            return PowerSupply.Command(address=s[1], function=s[2], data1=s[3:6], data2=s[6:9], device=s[9:12])
+            if not (len(s) == _FRAME_LEN and s[0] == '<' and s[-1] == '>'):
+                raise ValueError(f'Invalid frame: {s!r}')
+            return PowerSupply.Command(s[1], s[2], s[3:6], s[6:9], s[9:12])
         
         @staticmethod
         def from_bytes(b: bytes):
-            assert b
-            assert len(b)== 13
-            assert b[0:1] == b'<'
-            assert b[-1:] == b'>'
-            return PowerSupply.Command.from_str(b.decode())
+            if not (len(b) == _FRAME_LEN and b[0:1] == _LT and b[-1:] == _GT):
+                raise ValueError(f'Invalid frame: {b!r}')
+            s = b.decode()
+            return PowerSupply.Command(s[1], s[2], s[3:6], s[6:9], s[9:12])
+
+        # Split a response frame into (address, function, data1, data2, device) bytes without constructing a Command
+        @staticmethod
+        def parse_response_bytes(b: bytes):
+            if not (len(b) == _FRAME_LEN and b[0:1] == _LT and b[-1:] == _GT):
+                raise ValueError(f'Invalid frame: {b!r}')
+            return b[1:2], b[2:3], b[3:6], b[6:9], b[9:12]
 
         def is_ok_rsp(self):
             return self.data1 == 'OK0'
@@ -93,17 +151,59 @@ class PowerSupply(AbstractContextManager[Any]):
         CONSTANT_CURRENT = 'C'
 
 
-    def __init__(self, port: serial.Serial|str, max_voltage: int|None = 60, max_current: int|None = 5):
+    # pipeline() state is kept per thread, so commands from other threads are not queued into a pipeline they did not open
+    class _PipelineState(threading.local):
+        batch: bytearray | None = None
+        pending: list['PowerSupply.PendingResponse'] | None = None
+
+
+    # Placeholder returned for commands queued inside pipeline(), resolved when the pipeline is flushed
+    @dataclass
+    class PendingResponse:
+        response: 'PowerSupply.Command | None' = None
+        on_response: 'Callable[[PowerSupply.Command | None], None] | None' = field(default=None, repr=False)
+
+        def __bool__(self):
+            return bool(self.response)
+
+        def is_ok_rsp(self):
+            return self.response is not None and self.response.is_ok_rsp()
+
+
+    # read_timeout/write_timeout are only applied when opening the port by name.
+    # write_timeout=0 makes writes non-blocking, a write that cannot be queued completely raises SerialTimeoutException.
+    # threaded=True starts a background thread that continuously reads responses from the port.
+    # It blocks in read(), so it cannot be combined with a non-blocking port (read timeout 0).
+    def __init__(self, port: serial.Serial|str, max_voltage: int|None = 60, max_current: int|None = 5,
+                 read_timeout: float|None = _TIMEOUT, write_timeout: float|None = _TIMEOUT, threaded: bool = False):
+        if threaded and (read_timeout if isinstance(port, str) else port.timeout) == 0:
+            raise ValueError('threaded=True requires a read timeout other than 0')
+
         self._close_port = False
         self.max_voltage = max_voltage
         self.max_current = max_current
+        self._pipeline = PowerSupply._PipelineState()
+        self._last_voltage = None
+        self._last_current = None
 
         if isinstance(port, str):
-            self.port = serial.Serial(port=port, baudrate=9600, timeout=_TIMEOUT, write_timeout=_TIMEOUT)
+            self.port = serial.Serial(port=port, baudrate=9600, timeout=read_timeout, write_timeout=write_timeout)
             self._close_port = True
+            # Frames are 13 bytes, small driver buffers hand them to userspace sooner (only supported on Windows)
+            try:
+                self.port.set_buffer_size(rx_size=256, tx_size=256) # type: ignore
+            except AttributeError:
+                pass
         else:
             self.port = port
 
+        self._tx_lock = threading.Lock()
+        self._rx_q = queue.Queue()
+        self._reader = None
+        if threaded:
+            self._reader = threading.Thread(target=self._rx_loop, name=f'{type(self).__name__} reader', daemon=True)
+            self._reader.start()
+
 
     def __enter__(self):
         return self
@@ -112,92 +212,276 @@ class PowerSupply(AbstractContextManager[Any]):
     def __exit__(self, *args, **kwargs) -> bool | None: # type: ignore
         if self._close_port:
             self.close()
+        else:
+            # Caller-supplied ports stay open, but must not be read by the reader thread anymore
+            self._stop_reader()
         return super().__exit__(*args, **kwargs) # type: ignore
     
 
     def close(self):
+        self._stop_reader()
         self.port.close()
 
 
+    def _stop_reader(self):
+        reader, self._reader = self._reader, None
+        if reader is not None:
+            self.port.cancel_read()
+            reader.join()
+
+
+    def _rx_loop(self):
+        # The read timeout is not aligned with the commands, so a response may be split across reads.
+        # Partial frames are kept until complete, only full frames are queued.
+        rsp_data = b''
+        while self._reader is not None:
+            try:
+                rsp_data += self.port.read(_FRAME_LEN - len(rsp_data))
+            except serial.SerialException:
+                _log.debug('Reader thread stopped', exc_info=True)
+                break
+            # Resynchronize on the latest frame start, this also drops partial frames that were never completed
+            start = rsp_data.rfind(_LT)
+            if start != 0 and rsp_data:
+                _log.warning('WARNING: Discarding stray bytes in front of response: %s', rsp_data[:start] if start > 0 else rsp_data)
+                rsp_data = rsp_data[start:] if start > 0 else b''
+            if len(rsp_data) == _FRAME_LEN:
+                self._rx_q.put(rsp_data)
+                rsp_data = b''
+
+
+    @contextmanager
+    def pipeline(self):
+        """Queue all commands sent inside the block and transmit them with a single write on exit.
+
+        Commands that expect a response return a PendingResponse which is resolved once the
+        block is left. The yielded list is filled with all responses in order, None for
+        responses that were not received.
+        Reading commands (read_voltage, read_current) cannot be pipelined.
+        The pipeline only collects commands sent from the thread that opened it.
+        """
+        assert self._pipeline.batch is None, 'Pipelines cannot be nested'
+        self._pipeline.batch = bytearray()
+        self._pipeline.pending = []
+        responses: list[PowerSupply.Command | None] = []
+        try:
+            yield responses
+            batch, pending = bytes(self._pipeline.batch), self._pipeline.pending
+        finally:
+            self._pipeline.batch = None
+            self._pipeline.pending = None
+
+        if not batch:
+            return
+        with self._tx_lock:
+            _log.debug("CMD -> %s (%s responses expected)", batch, len(pending))
+            if pending:
+                self._discard_stale_input()
+            self._write(batch)
+            for p in pending:
+                rsp_data = self._read_response()
+                p.response = PowerSupply.Command.from_bytes(rsp_data) if rsp_data else None
+                responses.append(p.response)
+                if p.on_response is not None:
+                    p.on_response(p.response)
+
+
     def send_cmd(self, cmd: Command, read_response: bool = True):
-        cmd_data = cmd.encode()
-        _log.debug(f"CMD -> {cmd_data} = {cmd}")
-        self.port.write(cmd_data)
-        if read_response:
-            rsp_data = self.port.read_until(b'>')
-            if rsp_data:
-                rsp_cmd = PowerSupply.Command.from_bytes(rsp_data)
-                _log.debug(f"RSP <- {rsp_data} = {rsp_cmd}")
-                return rsp_cmd
+        return self._send_raw_cmd(cmd.encode(), read_response)
+
+
+    # Like _send_raw(), but returns the response as a Command
+    def _send_raw_cmd(self, cmd_data: bytes, read_response: bool = True):
+        rsp = self._send_raw(cmd_data, read_response)
+        if isinstance(rsp, bytes):
+            return PowerSupply.Command.from_bytes(rsp)
+        return rsp
+
+
+    def _send_raw(self, cmd_data: bytes, read_response: bool = True):
+        _log.debug("CMD -> %s", cmd_data)
+        if self._pipeline.batch is not None:
+            self._pipeline.batch += cmd_data
+            if read_response:
+                pending = PowerSupply.PendingResponse()
+                self._pipeline.pending.append(pending) # type: ignore
+                return pending
+            return None
+        with self._tx_lock:
+            if read_response:
+                self._discard_stale_input()
+            self._write(cmd_data)
+            if read_response:
+                return self._read_response()
+
+
+    # Drop late responses to earlier commands that timed out, so they are not mistaken for the next response
+    def _discard_stale_input(self):
+        if self._reader is not None:
+            try:
+                while True:
+                    _log.warning('WARNING: Discarding stale response: %s', self._rx_q.get_nowait())
+            except queue.Empty:
+                pass
+        else:
+            self.port.reset_input_buffer()
+
+
+    def _write(self, data: bytes):
+        written = self.port.write(data)
+        # Non-blocking writes (write_timeout=0) return early if the OS buffer is full
+        if written is not None and written < len(data):
+            raise serial.SerialTimeoutException(f'Write timeout: only {written} of {len(data)} bytes written')
+
+
+    def _read_frame(self):
+        # Responses are fixed length, read them in one go instead of byte by byte with read_until()
+        rsp_data = self.port.read(_FRAME_LEN)
+        if rsp_data and rsp_data[0:1] != _LT:
+            _log.warning('WARNING: Discarding stray bytes in front of response: %s', rsp_data)
+            start = rsp_data.find(_LT)
+            if start < 0:
+                rsp_data = self.port.read_until(_LT)
+                if rsp_data[-1:] != _LT:
+                    return b''
+                start = len(rsp_data) - 1
+            rsp_data = rsp_data[start:]
+            rsp_data += self.port.read(_FRAME_LEN - len(rsp_data))
+        return rsp_data
+
+
+    def _read_response(self):
+        if self._reader is not None:
+            try:
+                rsp_data = self._rx_q.get(timeout=self.port.timeout)
+            except queue.Empty:
+                rsp_data = b''
+        else:
+            rsp_data = self._read_frame()
+        if rsp_data:
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("RSP <- %s = %s", rsp_data, PowerSupply.Command.from_bytes(rsp_data))
+            return rsp_data
+        return None
 
 
     def output(self, enable: bool):
-        _log.info(f'Set output: {enable}')
+        _log.info('Set output: %s', enable)
         # No response for output enable/disable command
-        self.send_cmd(PowerSupply.Command(function=PowerSupply.Command.Function.ENABLE_OUTPUT if enable else PowerSupply.Command.Function.DISABLE_OUTPUT), read_response=False)
+        self._send_raw(_CMD_ENABLE_OUTPUT if enable else _CMD_DISABLE_OUTPUT, read_response=False)
 
 
-    def set_voltage(self, voltage: float):
-        assert math.isfinite(voltage)
-        assert voltage >= 0
+    # Setting the same value as the last successful set_voltage() call is skipped and returns the previous response,
+    # use force=True if the setpoint may have been changed in the meantime (e.g. on the front panel)
+    def set_voltage(self, voltage: float, force: bool = False):
+        voltage = _limit_setpoint(voltage, self.max_voltage, 'voltage')
 
-        if self.max_voltage is not None and voltage > self.max_voltage:
-            _log.warning(f'WARNING: Requested voltage {voltage} > maximum voltage {self.max_voltage}')
-            voltage = min(voltage, self.max_voltage)
+        millis = round(voltage * 1000)
+        cached_rsp = _cached_setpoint_rsp(self._last_voltage, millis, force)
+        if cached_rsp is not None:
+            _log.info('Voltage already set: %sV', voltage)
+            return cached_rsp
 
-        _log.info(f'Set voltage: {voltage}V')
+        _log.info('Set voltage: %sV', voltage)
 
-        int_part, fractional_part = _split_int_fractional(voltage)
-        fractional_part = int(fractional_part*1000)
+        rsp = self._send_raw_cmd(_encode_setpoint(_FUNC_SET_VOLTAGE, millis))
+        self._cache_setpoint('_last_voltage', millis, rsp)
+        return rsp
 
-        cmd = PowerSupply.Command(function=PowerSupply.Command.Function.SET_VOLTAGE, data1=f'{int_part:03}', data2=f'{fractional_part:03}')
-        return self.send_cmd(cmd)
 
+    # Setting the same value as the last successful set_current() call is skipped and returns the previous response,
+    # use force=True if the setpoint may have been changed in the meantime (e.g. on the front panel)
+    def set_current(self, current: float, force: bool = False):
+        current = _limit_setpoint(current, self.max_current, 'current')
 
-    def set_current(self, current: float):
-        assert math.isfinite(current)
-        assert current >= 0
+        millis = round(current * 1000)
+        cached_rsp = _cached_setpoint_rsp(self._last_current, millis, force)
+        if cached_rsp is not None:
+            _log.info('Current already set: %sA', current)
+            return cached_rsp
 
-        if self.max_current is not None and current > self.max_current:
-            _log.warning(f'WARNING: Requested current {current} > maximum current {self.max_current}')
-            current = min(current, self.max_current)
+        _log.info('Set current: %sA', current)
 
-        _log.info(f'Set current: {current}A')
+        rsp = self._send_raw_cmd(_encode_setpoint(_FUNC_SET_CURRENT, millis))
+        self._cache_setpoint('_last_current', millis, rsp)
+        return rsp
 
-        int_part, fractional_part = _split_int_fractional(current)
-        fractional_part = int(fractional_part*1000)
 
-        cmd = PowerSupply.Command(function=PowerSupply.Command.Function.SET_CURRENT, data1=f'{int_part:03}', data2=f'{fractional_part:03}')
-        return self.send_cmd(cmd)
+    def _cache_setpoint(self, attr: str, millis: int, rsp: 'PowerSupply.Command | PowerSupply.PendingResponse | None'):
+        setattr(self, attr, _setpoint_cache_entry(millis, rsp))
+        # Pipelined setpoints are cached once their response arrives
+        if isinstance(rsp, PowerSupply.PendingResponse):
+            rsp.on_response = lambda r: setattr(self, attr, _setpoint_cache_entry(millis, r))
 
 
     # Should be correct according to documentation, but returned data did not really make sense on the tested unit
     # Returned constant voltage/current mode is correct
     def read_voltage(self):
-        _log.info(f'Read voltage')
-        cmd = PowerSupply.Command(function=PowerSupply.Command.Function.READ_VOLTAGE)
-        rsp = self.send_cmd(cmd)
+        assert self._pipeline.batch is None, 'read_voltage() cannot be pipelined'
+        _log.info('Read voltage')
+        rsp = self._send_raw(_CMD_READ_VOLTAGE)
         if rsp:
-            voltage = int(rsp.data1) + int(rsp.data2) / 1000.0
-            _log.info(f'Voltage: {voltage}')
-            return voltage, PowerSupply.Mode.CONSTANT_VOLTAGE if rsp.address == '1' else PowerSupply.Mode.CONSTANT_CURRENT
+            voltage, mode = _parse_measurement(rsp)
+            _log.info('Voltage: %s', voltage)
+            return voltage, mode
         return None
 
 
     # Should be correct according to documentation, but returned data did not really make sense on the tested unit
     # Returned constant voltage/current mode is correct
     def read_current(self):
-        _log.info(f'Read current')
-        cmd = PowerSupply.Command(function=PowerSupply.Command.Function.READ_CURRENT)
-        rsp = self.send_cmd(cmd)
+        assert self._pipeline.batch is None, 'read_current() cannot be pipelined'
+        _log.info('Read current')
+        rsp = self._send_raw(_CMD_READ_CURRENT)
         if rsp:
-            current = int(rsp.data1) + int(rsp.data2) / 1000.0
-            _log.info(f'Current: {current}')
-            return current, PowerSupply.Mode.CONSTANT_VOLTAGE if rsp.address == '1' else PowerSupply.Mode.CONSTANT_CURRENT
+            current, mode = _parse_measurement(rsp)
+            _log.info('Current: %s', current)
+            return current, mode
         return None
 
 
     def lock_buttons(self, lock: bool):
-        _log.info(f'Set button lock: {lock}')
-        return self.send_cmd(PowerSupply.Command(function=PowerSupply.Command.Function.LOCK, data1=(PowerSupply.Command.LockData1.LOCK if lock else PowerSupply.Command.LockData1.UNLOCK)))
+        _log.info('Set button lock: %s', lock)
+        return self._send_raw_cmd(_CMD_LOCK if lock else _CMD_UNLOCK)
+
+
+    # Set voltage, current limit and output state, None leaves a setting unchanged.
+    # The setpoints (and disabling the output) are sent with a single write. The output is only enabled
+    # afterwards, once all requested setpoints were acknowledged with OK.
+    # Returns the (voltage, current) responses, None if not set or no response was received.
+    def apply(self, voltage: float | None = None, current: float | None = None, enable: bool | None = None):
+        voltage_rsp = current_rsp = None
+        with self.pipeline():
+            if enable is False:
+                self.output(False)
+            if voltage is not None:
+                voltage_rsp = self.set_voltage(voltage)
+            if current is not None:
+                current_rsp = self.set_current(current)
+
+        # Unchanged setpoints are not sent and return the previous response directly
+        if isinstance(voltage_rsp, PowerSupply.PendingResponse):
+            voltage_rsp = voltage_rsp.response
+        if isinstance(current_rsp, PowerSupply.PendingResponse):
+            current_rsp = current_rsp.response
+
+        if enable:
+            if _setpoints_ok((voltage, voltage_rsp), (current, current_rsp)):
+                self.output(True)
+            else:
+                _log.warning('WARNING: Output not enabled, setpoints were not acknowledged')
+        return voltage_rsp, current_rsp
+
+
+# Pre-encoded function codes of the setpoint commands, the only commands encoded at runtime
+_FUNC_SET_VOLTAGE = PowerSupply.Command.Function.SET_VOLTAGE.encode('ascii')
+_FUNC_SET_CURRENT = PowerSupply.Command.Function.SET_CURRENT.encode('ascii')
+
+# Pre-encoded commands without any runtime-varying fields
+_CMD_ENABLE_OUTPUT = PowerSupply.Command(function=PowerSupply.Command.Function.ENABLE_OUTPUT).encode()
+_CMD_DISABLE_OUTPUT = PowerSupply.Command(function=PowerSupply.Command.Function.DISABLE_OUTPUT).encode()
+_CMD_READ_VOLTAGE = PowerSupply.Command(function=PowerSupply.Command.Function.READ_VOLTAGE).encode()
+_CMD_READ_CURRENT = PowerSupply.Command(function=PowerSupply.Command.Function.READ_CURRENT).encode()
+_CMD_LOCK = PowerSupply.Command(function=PowerSupply.Command.Function.LOCK, data1=PowerSupply.Command.LockData1.LOCK).encode()
+_CMD_UNLOCK = PowerSupply.Command(function=PowerSupply.Command.Function.LOCK, data1=PowerSupply.Command.LockData1.UNLOCK).encode()
 
@@ -30,70 +30,127 @@ import kuaiqu_psu
 
 TIMEOUT = 1
 
-def simple_test(psu: kuaiqu_psu.PowerSupply):
-    psu.output(True)
-    sleep(1)
+# Delay between test steps, the PSU itself does not need any pause between commands
+_INTER_CMD = 0.05
+# Time for the output to settle after changing the setpoints
+_SETTLE_MS = 2000
 
-    if not psu.set_voltage(5.15):
+def simple_test(psu: kuaiqu_psu.PowerSupply, settle_ms: int = _SETTLE_MS):
+    voltage_status, current_status = psu.apply(5.15, 0.250, True)
+
+    if not (voltage_status and voltage_status.is_ok_rsp()):
         _log.error('ERROR: Failed to set output voltage')
         return 1
-    sleep(1)
 
-    if not psu.set_current(0.250):
+    if not (current_status and current_status.is_ok_rsp()):
         _log.error('ERROR: Failed to set output current limit')
         return 1
-    sleep(1)
+    sleep(_INTER_CMD)
 
     v = psu.read_voltage()
     if not v:
         _log.error('ERROR: Failed to read voltage')
         return 1
     else:
-        _log.info(f'Voltage: {v}')
+        _log.info('Voltage: %s', v)
     c = psu.read_current()
     if not c:
         _log.error('ERROR: Failed to read current')
         return 1
-    _log.info(f'Current: {c}')
-    sleep(1)
+    _log.info('Current: %s', c)
+    sleep(_INTER_CMD)
 
     if not psu.lock_buttons(True):
         _log.error('ERROR: Failed to lock buttons')
         return 1
-    sleep(1)
+    sleep(_INTER_CMD)
+
+    with psu.pipeline():
+        current_status = psu.set_current(0.100)
+        voltage_status = psu.set_voltage(3.3)
 
-    if not psu.set_current(0.100):
+    if not (current_status and current_status.is_ok_rsp()):
         _log.error('ERROR: Failed to set output current limit')
         return 1
-    sleep(1)
 
-    if not psu.set_voltage(3.3):
+    if not (voltage_status and voltage_status.is_ok_rsp()):
         _log.error('ERROR: Failed to set output voltage')
         return 1
-    sleep(2)
+    sleep(settle_ms / 1000)
 
     if not psu.lock_buttons(False):
         _log.error('ERROR: Failed to unlock buttons')
         return 1
-    sleep(1)
+    sleep(_INTER_CMD)
 
-    psu.output(False)
-    sleep(1)
+    voltage_status, current_status = psu.apply(0, 0, False)
 
-    if not psu.set_voltage(0):
+    if not (voltage_status and voltage_status.is_ok_rsp()):
         _log.error('ERROR: Failed to set output voltage')
         return 1
-    
-    if not psu.set_current(0):
+
+    if not (current_status and current_status.is_ok_rsp()):
         _log.error('ERROR: Failed to set output current limit')
         return 1
 
     return 0
 
-def kuaiquctl():
+# Setpoints that were not acknowledged with OK count as failed, apply() does not enable the output in that case
+def check_setpoints(args: argparse.Namespace, voltage_status: kuaiqu_psu.PowerSupply.Command | None,
+                    current_status: kuaiqu_psu.PowerSupply.Command | None, serial_port: str):
+    if args.volt is not None and not (voltage_status and voltage_status.is_ok_rsp()):
+        _log.error('ERROR: %s: Failed to set output voltage', serial_port)
+        return 1
+
+    if args.ampere is not None and not (current_status and current_status.is_ok_rsp()):
+        _log.error('ERROR: %s: Failed to set output current limit', serial_port)
+        return 1
+
+    return 0
+
+def output_state(args: argparse.Namespace):
+    return True if args.enable else False if args.disable else None
+
+def set_outputs(psu: kuaiqu_psu.PowerSupply, args: argparse.Namespace, serial_port: str):
+    try:
+        voltage_status, current_status = psu.apply(args.volt, args.ampere, output_state(args))
+    except ValueError as e:
+        _log.error('ERROR: %s: %s', serial_port, e)
+        return 1
+
+    return check_setpoints(args, voltage_status, current_status, serial_port)
+
+async def set_outputs_parallel(args: argparse.Namespace):
+    # Imported here to keep startup fast, asyncio is only needed for --parallel and pyserial-asyncio is optional
+    import asyncio
+    from kuaiqu_psu.aio import AsyncPowerSupply
+
+    async def set_outputs_async(serial_port: str):
+        async with await AsyncPowerSupply.open(serial_port, max_current=None, max_voltage=None) as psu:
+            try:
+                voltage_status, current_status = await psu.apply(args.volt, args.ampere, output_state(args))
+            except ValueError as e:
+                _log.error('ERROR: %s: %s', serial_port, e)
+                return 1
+
+            return check_setpoints(args, voltage_status, current_status, serial_port)
+
+    return max(await asyncio.gather(*(set_outputs_async(p) for p in args.serial_port)))
+
+# Defaults of all options, shared by the parser and the fast path in _parse_fast_path()
+_ARG_DEFAULTS = dict(parallel=False, volt=None, ampere=None, enable=False, disable=False,
+                     run_test=False, settle_ms=_SETTLE_MS, verbose=False, quiet=False)
+
+def _non_negative_int(value: str):
+    if not value.isdecimal():
+        raise argparse.ArgumentTypeError(f'must be a non-negative integer: {value!r}')
+    return int(value)
+
+def _build_parser():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('serial_port', type=str)
+    parser.add_argument('serial_port', type=str, nargs='+')
+    parser.add_argument('--parallel', action='store_true', help='Configure multiple power supplies concurrently (requires pyserial-asyncio)')
 
     group = parser.add_argument_group('Power supply output options')
     group.add_argument('-v', '-u', '--volt', type=float, help='Set the output voltage')
@@ -104,41 +161,54 @@ def kuaiquctl():
     enable_group.add_argument('-d', '--disable', action='store_true', help='Disable output')
 
     parser.add_argument('--run_test', action='store_true', help='Run simple functionality test (WARNING: enables PSU output)')
+    parser.add_argument('--settle-ms', type=_non_negative_int, help='Output settling time in ms after setpoint changes in the functionality test')
 
     verbose_group = group.add_mutually_exclusive_group()
     verbose_group.add_argument('--verbose', action='store_true')
     verbose_group.add_argument('--quiet', action='store_true')
 
-    args = parser.parse_args()
+    parser.set_defaults(**_ARG_DEFAULTS)
+
+    return parser
+
+# Plain `kuaiquctl PORT -v VOLT` as commonly used from scripts, parsed without the argparse overhead
+def _parse_fast_path(argv: list[str]):
+    if len(argv) != 4 or argv[1].startswith('-') or argv[2] not in ('-v', '-u', '--volt'):
+        return None
+    try:
+        volt = float(argv[3])
+    except ValueError:
+        return None
+    return argparse.Namespace(**{**_ARG_DEFAULTS, 'serial_port': [argv[1]], 'volt': volt})
+
+def kuaiquctl():
+    args = _parse_fast_path(sys.argv)
+    if args is None:
+        parser = _build_parser()
+        args = parser.parse_args()
+
+        if args.parallel and args.run_test:
+            parser.error('--parallel cannot be combined with --run_test')
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(message)s')
     elif args.quiet:
         logging.basicConfig(level=logging.WARNING, format='%(message)s')
 
-    with kuaiqu_psu.PowerSupply(args.serial_port, max_current=None, max_voltage=None) as psu:
-        if not args.run_test:
-                if args.volt is not None:
-                    status = psu.set_voltage(args.volt)
-                    if not status:
-                        _log.error('ERROR: Failed to set output voltage')
-                        return 1
-
-                if args.ampere is not None:
-                    status = psu.set_current(args.ampere)
-                    if not status:
-                        _log.error('ERROR: Failed to set output current limit')
-                        return 1
-
-                if args.enable:
-                    psu.output(True)
-                elif args.disable:
-                    psu.output(False)
-
-        else:
-            return simple_test(psu)
-
-        return 0
+    if args.parallel:
+        import asyncio
+        return asyncio.run(set_outputs_parallel(args))
+
+    for serial_port in args.serial_port:
+        with kuaiqu_psu.PowerSupply(serial_port, max_current=None, max_voltage=None) as psu:
+            if not args.run_test:
+                status = set_outputs(psu, args, serial_port)
+            else:
+                status = simple_test(psu, args.settle_ms)
+            if status:
+                return status
+
+    return 0
 
 
 if __name__ == '__main__':